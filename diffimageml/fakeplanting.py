@@ -1,7 +1,9 @@
 import numpy as np
 import scipy
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
 
-import os, collections
+import os, collections, re
 
 from astroquery.gaia import Gaia
 
@@ -40,8 +42,11 @@ from mpl_toolkits.axes_grid1 import ImageGrid
 from .util import *
 
 # astropy Table format for the gaia source catalog
-_GAIACATFORMAT_ = 'ascii.ecsv'
-_GAIACATEXT_ = 'ecsv'
+_GAIACATFORMAT_ = 'fits'
+_GAIACATEXT_ = 'fits'
+# older catalogs were written as ascii text; still read them if present
+_GAIACATFORMAT_LEGACY_ = 'ascii.ecsv'
+_GAIACATEXT_LEGACY_ = 'ecsv'
 
 # Column names for the magnitudes and S/N to use for selecting viable PSF stars
 _GAIAMAGCOL_ =  'phot_rp_mean_mag'
@@ -99,6 +104,17 @@ class FitsImage:
         self.stellar_phot_table = None
         self.gaia_source_table = None
 
+        # Background2D sky map, kept from detect_sources for reuse
+        self._bkg2d = None
+
+        # ePSF models already built for this image, see build_epsf_model
+        self._epsf_cache = {}
+
+        # fake IDs and (x,y) locations read from the header, see
+        # FakePlanter.get_fake_locations; reset whenever fakes are planted
+        self._fake_ids = None
+        self._fake_xy = None
+
         self.read_fits_file(fitsfilename)
 
         return
@@ -118,14 +134,25 @@ class FitsImage:
         sci :  the science array :class:`~astropy.io.fits.PrimaryHDU` (or similar)
 
         """
-        self.hdulist = fits.open(fitsfilename)
+        # memory-map the data and only look at headers here, so that the
+        # pixel data (and decompression of .fz images) is not read until
+        # self.sci.data is first used
+        self.hdulist = fits.open(fitsfilename, memmap=True,
+                                 lazy_load_hdus=True)
         self.filename = fitsfilename
         if 'SCI' in self.hdulist:
             self.sci = self.hdulist['SCI']
         else:
-            for i in range(len(self.hdulist)):
-                if self.hdulist[i].data is not None:
-                    self.sci = self.hdulist[i]
+            for hdu in self.hdulist:
+                # (tables have NAXIS=2 too, so check for an image hdu)
+                if hdu.is_image and hdu.header.get('NAXIS', 0) >= 2:
+                    self.sci = hdu
+                    break
+
+        # work in float32 throughout. BITPIX=-32 images are already float32,
+        # so only read in (and convert) the pixels of other images here
+        if self.sci.header.get('BITPIX') != -32:
+            self.sci.data = self.sci.data.astype(np.float32, copy=False)
 
         # image World Coord System
         self.wcs = WCS(self.sci.header)
@@ -142,21 +169,15 @@ class FitsImage:
         """
         Given a pixel location returns the skycoord
         """
-        hdu = self.sci
-        hdr = hdu.header
-        wcs,frame = WCS(hdr),hdr['RADESYS'].lower()
         xp,yp = pixel
-        sky = wcsutils.pixel_to_skycoord(xp,yp,wcs)
+        sky = wcsutils.pixel_to_skycoord(xp,yp,self.wcs)
         return sky
 
     def skytopix(self,sky):
         """
         Given a skycoord (or list of skycoords) returns the pixel locations
         """
-        hdu = self.sci
-        hdr = hdu.header
-        wcs,frame = WCS(hdr),hdr['RADESYS'].lower()
-        pixel = wcsutils.skycoord_to_pixel(sky,wcs)
+        pixel = wcsutils.skycoord_to_pixel(sky,self.wcs)
         return pixel
 
     @property
@@ -164,7 +185,8 @@ class FitsImage:
         """Check if a list of detected sources exists """
         return self.sourcecatalog is not None
 
-    def detect_sources(self,nsigma=2,kfwhm=2.0,npixels=5,deblend=False,contrast=.001, **kwargs):
+    def detect_sources(self,nsigma=2,kfwhm=2.0,npixels=5,deblend=False,contrast=.001,
+                       use_2d_background=False, use_gpu=False, **kwargs):
         """Detect sources (transient candidates) in the diff image using
         the astropy.photutils threshold-based source detection algorithm.
 
@@ -180,6 +202,14 @@ class FitsImage:
             Will use multiple levels/iterations to deblend single sources into multiple
         contrast : float
             If deblending the flux ratio required for local peak to be considered its own object
+        use_2d_background : bool
+            If True, model the sky with a (slower) photutils Background2D map.
+            Otherwise use a single global sigma-clipped median and std.
+        use_gpu : bool
+            If True, run the smoothing, thresholding and segmentation on a GPU
+            with cupy (useful for very large images). The sky level and noise
+            are then a global median and MAD. Falls back to the CPU if cupy
+            is not installed.
 
         Returns
         -------
@@ -199,36 +229,73 @@ class FitsImage:
         # maybe separate?: run PSF fitting photometry on each fake source
         # to be able to translate from ra/dec <--> pixels on image
 
-        hdr = self.sci.header
-        wcs,frame = WCS(hdr),hdr['RADESYS'].lower()
         #L1mean,L1med,L1sigma,L1fwhm = hdr['L1MEAN'],hdr['L1MEDIAN'],hdr['L1SIGMA'],hdr['L1FWHM'] # counts, fwhm in arcsec 
         #pixscale,saturate,maxlin = hdr['PIXSCALE'],hdr['SATURATE'],hdr['MAXLIN'] # arcsec/pixel, counts for saturation and non-linearity levels
         # if bkg None: detect threshold uses sigma clipped statistics to get bkg flux and set a threshold for detected sources
         # bkg also available in the hdr of file, either way is fine  
         # threshold = detect_threshold(hdu.data, nsigma=nsigma)
         # or you can provide a bkg of the same shape as data and this will be used
-        boxsize=200
-        bkg = Background2D(self.sci.data,boxsize) # sigma-clip stats for background est over image on boxsize, regions interpolated to give final map 
-        threshold = detect_threshold(self.sci.data, nsigma=nsigma,background=bkg.background)
         ksigma = kfwhm * gaussian_fwhm_to_sigma  # FWHM pixels for kernel smoothing
         # optional ~ kernel smooths the image, using gaussian weighting
         kernel = Gaussian2DKernel(ksigma)
         kernel.normalize()
-        # make a segmentation map, id sources defined as n connected pixels above threshold 
-        segm = detect_sources(self.sci.data,
-                              threshold, npixels=npixels, filter_kernel=kernel)
+
+        if use_gpu:
+            try:
+                segm, convolved_data, background = detect_sources_gpu(
+                    self.sci.data, kernel, nsigma=nsigma, npixels=npixels)
+            except ImportError:
+                print("cupy is not available. Detecting sources on the CPU.")
+                use_gpu = False
+            else:
+                # the gpu path uses a global sky level
+                use_2d_background = False
+                self._bkg2d = None
+
+        if not use_gpu:
+            if use_2d_background:
+                boxsize=200
+                bkg = Background2D(self.sci.data,boxsize) # sigma-clip stats for background est over image on boxsize, regions interpolated to give final map 
+                self._bkg2d = bkg
+                background = bkg.background
+                threshold = detect_threshold(self.sci.data, nsigma=nsigma,background=background)
+            else:
+                # a sky map from an earlier run no longer applies
+                self._bkg2d = None
+                # one sigma-clipping pass gives both the sky level and the noise
+                _, background, bkg_std = sigma_clipped_stats(self.sci.data, sigma=3.0)
+                threshold = background + nsigma * bkg_std
+            # smooth once with an FFT convolution (zero-filled edges, as photutils
+            # does) and hand the smoothed image to the segmentation steps, rather
+            # than having each of them convolve the image again.
+            # a NaN/inf would spread over the whole FFT result, so those pixels
+            # are filled with the sky level first and masked again afterwards
+            data = self.sci.data
+            bad = ~np.isfinite(data)
+            if bad.any():
+                data = np.where(bad, background, data)
+            convolved_data = fftconvolve(data, kernel.array, mode='same')
+            if bad.any():
+                convolved_data[bad] = np.nan
+            # make a segmentation map, id sources defined as n connected pixels above threshold 
+            segm = detect_sources(convolved_data,
+                                  threshold, npixels=npixels, filter_kernel=None)
         # deblend useful for very crowded image with many overlapping objects...
         # uses multi-level threshold and watershed segmentation to sep local peaks as ind obj
         # use the same number of pixels and filter as was used on original segmentation
         # contrast is fraction of source flux local pk has to be consider its own obj
         if deblend:
-            segm = deblend_sources(self.sci.data, 
-                                           segm, npixels=5,filter_kernel=kernel, 
+            segm = deblend_sources(convolved_data, 
+                                           segm, npixels=5,filter_kernel=None, 
                                            nlevels=32,contrast=contrast)
         # need bkg subtracted to do photometry using source properties
-        data_bkgsub = self.sci.data - bkg.background
-        cat = source_properties(data_bkgsub, segm,background=bkg.background,
-                                error=None,filter_kernel=kernel)
+        data_bkgsub = self.sci.data - background
+        if use_2d_background:
+            cat = source_properties(data_bkgsub, segm,background=background,
+                                    error=None,filter_kernel=kernel)
+        else:
+            cat = source_properties(data_bkgsub, segm,background=None,
+                                    error=None,filter_kernel=kernel)
 
         # TODO the detection parameters into meta of table
         meta = {'detect_params':{"nsigma":nsigma,"kfwhm":kfwhm,"npixels":npixels,
@@ -302,7 +369,8 @@ class FitsImage:
     
     def plant_fakes_in_sci(self, psfmodel, posflux, subshape=None,
                            preserve_original=False,
-                           writetodisk=False, save_suffix="withfakes"):
+                           writetodisk=False, save_suffix="withfakes",
+                           copy_psf=True):
         """
         Add PSF/PRFs ("fakes") to the image data array.
         Also update the header to record the pixel positions and fluxes for
@@ -320,7 +388,9 @@ class FitsImage:
 
         subshape : length-2 or None
             The shape of the region around the center of the location to
-            add the PSF to.  If None, add to the whole image.
+            add the PSF to.  If None, use a square stamp ~4 FWHM on a side
+            (or, if the header has no FWHM, the footprint of the psf model;
+            see get_stamp_shape).
 
         preserve_original : bool
             if True, store a copy of the unmodified original sci HDU as
@@ -335,6 +405,9 @@ class FitsImage:
             suffix to use for the output fits files. Each filename is defined
             as  <original_fits_filename_root>_<save_suffix>.fits
 
+        copy_psf : bool
+            If False, the parameters of psfmodel are changed in place instead
+            of working on a copy of it.
 
         Returns
         -------
@@ -350,9 +423,6 @@ class FitsImage:
         data = self.sci.data
         hdr = self.sci.header
 
-        # TODO:  already have self.wcs and self.frame ??
-        wcs,frame = WCS(hdr),hdr['RADESYS'].lower()
-
         if data.ndim != 2:
             raise ValueError(f'{data.ndim}-d array not supported. Only 2-d '
                              'arrays can be passed to subtract_psf.')
@@ -369,75 +439,47 @@ class FitsImage:
             posflux = Table(names=['x_fit', 'y_fit', 'flux_fit'], data=posflux)
 
         # Set up constants across the loop
-        # TODO: Do we need a copy of the psf model here? Do we need a new copy
-        # for each fake that gets planted ?
-        psfmodelcopy = psfmodel.copy()
+        # the planting changes the model parameters, so work on a copy
+        # unless the caller says the model can be modified
         xname, yname, fluxname = extract_psf_fitting_names(psfmodel)
-        indices = np.indices(data.shape)
+        psf_flux = getattr(psfmodel, fluxname).value
+        if copy_psf:
+            psfmodelcopy = psfmodel.copy()
+        else:
+            psfmodelcopy = psfmodel
 
-        # TODO : now that we've got an option to preserve_original do we need copies here?
-        subbeddata = data.copy()
-        addeddata = data.copy()
-        
-        nfakes_planted = 0
+        # each fake is only evaluated on a small stamp around its position
         if subshape is None:
-            indicies_reversed = indices[::-1]
-
-            for row in posflux:
-                getattr(psfmodelcopy, xname).value = row['x_fit']
-                getattr(psfmodelcopy, yname).value = row['y_fit']
-                getattr(psfmodelcopy, fluxname).value = row['flux_fit']
-
-                xp,yp,flux_fit = row['x_fit'],row['y_fit'],row['flux_fit']
-                sky = wcsutils.pixel_to_skycoord(xp,yp,wcs)
-                idx = str(nfakes_planted).zfill(3)
-                hdr['FK{}X'.format(idx)] = xp
-                hdr['FK{}Y'.format(idx)] = yp
-                hdr['FK{}RA'.format(idx)] = str(sky.ra.hms)
-                hdr['FK{}DEC'.format(idx)] = str(sky.dec.dms)
-                hdr['FK{}F'.format(idx)] = flux_fit
-                # TO-DO, once have actual epsf classes will be clearer to fill the model
-                hdr['FK{}MOD'.format(idx)] = "NA"
-                nfakes_planted += 1
-
-                #subbeddata -= psfmodel(*indicies_reversed)
-                addeddata += psfmodelcopy(*indicies_reversed)
-        else:
-            for row in posflux:
-                x_0, y_0 = row['x_fit'], row['y_fit']
-
-                # float dtype needed for fill_value=np.nan
-                y = extract_array(indices[0].astype(float), subshape, (y_0, x_0))
-                x = extract_array(indices[1].astype(float), subshape, (y_0, x_0))
-
-                getattr(psfmodelcopy, xname).value = x_0
-                getattr(psfmodelcopy, yname).value = y_0
-                getattr(psfmodelcopy, fluxname).value = row['flux_fit']
-
-                xp,yp,flux_fit = row['x_fit'],row['y_fit'],row['flux_fit']
-                sky = wcsutils.pixel_to_skycoord(xp,yp,wcs)
-                idx = str(nfakes_planted).zfill(3)
-                hdr['FK{}X'.format(idx)] = xp
-                hdr['FK{}Y'.format(idx)] = yp
-                hdr['FK{}RA'.format(idx)] = str(sky.ra.hms)
-                hdr['FK{}DEC'.format(idx)] = str(sky.dec.dms)
-                hdr['FK{}F'.format(idx)] = flux_fit
-                # TO-DO, once have actual epsf classes will be clearer to fill the model
-                hdr['FK{}MOD'.format(idx)] = "NA"
-                nfakes_planted += 1
-                
-                addeddata = add_array(addeddata, psfmodelcopy(x, y), (y_0, x_0))
+            subshape = get_stamp_shape(hdr, psfmodel)
+
+        # a single copy of the image to plant into
+        addeddata = add_psf_stamps(data.copy(), psfmodelcopy, posflux, subshape)
+
+        # sky locations of all the fakes, converted in one call
+        skycoords = wcsutils.pixel_to_skycoord(
+            posflux['x_fit'], posflux['y_fit'], self.wcs)
+
+        # append the cards for all fakes at once; existing keywords only
+        # need to be looked up if fakes were recorded in this header before
+        hdr.extend(fake_header_cards(posflux, skycoords),
+                   update=('FK000X' in hdr))
+        nfakes_planted = len(posflux)
 
         # update the data array with all fakes in it
         self.sci.data = addeddata
+        self._fake_ids = None
+        self._fake_xy = None
+        # ePSF models and sky maps from the data before the fakes are stale now
+        self._epsf_cache = {}
+        self._bkg2d = None
 
         # inserting some new header values
         hdr['HASFAKES'] = True
         hdr['NFAKES'] = nfakes_planted
-        hdr['PSF_FLUX'] = getattr(psfmodel, fluxname).value
+        hdr['PSF_FLUX'] = psf_flux
         
         if writetodisk:
-            fits.writeto(save_suffix, self.sci.data, hdr, overwrite=True)
+            write_hdu(self.sci, save_suffix)
 
         self.fake_source_table = posflux
 
@@ -484,8 +526,9 @@ class FitsImage:
         if save_suffix:
             root = os.path.splitext(os.path.splitext(self.filename)[0])[0]
             savefilename = root + '_' + save_suffix + '.' + _GAIACATEXT_
-            if os.path.isfile(savefilename) and not overwrite:
-                print("Gaia catalog {} exists. \n".format(savefilename) + \
+            catfilename, catformat = self._find_gaia_catalog(save_suffix)
+            if catfilename is not None and not overwrite:
+                print("Gaia catalog {} exists. \n".format(catfilename) + \
                       "Reading without fetching.")
                 self.read_gaia_sources(save_suffix=save_suffix)
                 return
@@ -529,17 +572,13 @@ class FitsImage:
         sncol = MaskedColumn(data=full_gaia_source_table[_GAIASNCOL_],
                               name='signal_to_noise')
 
-        # add columns  x and y (pixel locations on image)
-        #sky_positions= []
-        pixel_positions=[]
-        for i in range(len(full_gaia_source_table)):
-            sky_pos = SkyCoord(ra=racol[i], dec=deccol[i],
-                               unit=units.deg, frame=self.frame)
-            #sky_positions.append(sky_pos)
-            pixel_pos = wcsutils.skycoord_to_pixel(sky_pos, self.wcs)
-            pixel_positions.append(pixel_pos)
-        xcol = Column([pos[0] for pos in pixel_positions], name='x')
-        ycol = Column([pos[1] for pos in pixel_positions], name='y')
+        # add columns  x and y (pixel locations on image), converting
+        # all the sources with a single call to the image WCS
+        sky_positions = SkyCoord(ra=racol, dec=deccol,
+                                 unit=units.deg, frame=self.frame)
+        xpix, ypix = wcsutils.skycoord_to_pixel(sky_positions, self.wcs)
+        xcol = Column(xpix, name='x')
+        ycol = Column(ypix, name='y')
 
         # create a minimalist Table
         self.gaia_source_table = Table(
@@ -553,22 +592,38 @@ class FitsImage:
         if save_suffix:
             if os.path.exists(savefilename):
                 os.remove(savefilename)
-            # TODO : make more space-efficient as a binary table?
             self.gaia_source_table.write(
-                savefilename, format=_GAIACATFORMAT_)
+                savefilename, format=_GAIACATFORMAT_, overwrite=True)
             self.gaia_source_table.savefilename = savefilename
 
         return
 
 
+    def _find_gaia_catalog(self, save_suffix='GaiaCat'):
+        """Return the filename and astropy Table format of an existing Gaia
+        catalog for this image, preferring the binary FITS table over a
+        legacy ascii one.  Returns (None, None) if neither exists.
+        """
+        root = os.path.splitext(os.path.splitext(self.filename)[0])[0]
+        for ext, fmt in [(_GAIACATEXT_, _GAIACATFORMAT_),
+                         (_GAIACATEXT_LEGACY_, _GAIACATFORMAT_LEGACY_)]:
+            catfilename = root + '_' + save_suffix + '.' + ext
+            if os.path.isfile(catfilename):
+                return catfilename, fmt
+        return None, None
+
+
     def read_gaia_sources(self, save_suffix='GaiaCat'):
         """Read in an existing catalog of sources from the Gaia
          database that are within the bounds of this image.
 
         Requires that fetch_gaia_sources() has previously been run,
-        with save_suffix provided to save the catalog as an ascii
-        text file named as
+        with save_suffix provided to save the catalog as a binary
+        FITS table named as
         <rootname_of_this_fits_file>_<save_suffix>.<_GAIACATEXT_>
+        If that does not exist, a legacy ascii catalog
+        <rootname_of_this_fits_file>_<save_suffix>.<_GAIACATEXT_LEGACY_>
+        is read instead.
 
         Parameters
         ----------
@@ -576,13 +631,13 @@ class FitsImage:
         save_suffix: str
             The suffix of the Gaia source catalog filename.
         """
-        root = os.path.splitext(os.path.splitext(self.filename)[0])[0]
-        catfilename = root + '_' + save_suffix + '.' + _GAIACATEXT_
-        if not os.path.isfile(catfilename):
-            print("Error: {} does not exist.".format(catfilename))
+        catfilename, catformat = self._find_gaia_catalog(save_suffix)
+        if catfilename is None:
+            root = os.path.splitext(os.path.splitext(self.filename)[0])[0]
+            print("Error: {} does not exist.".format(
+                root + '_' + save_suffix + '.' + _GAIACATEXT_))
             return -1
-        self.gaia_source_table = Table.read(
-            catfilename, format=_GAIACATFORMAT_)
+        self.gaia_source_table = Table.read(catfilename, format=catformat)
         return 0
 
 
@@ -644,16 +699,18 @@ class FitsImage:
         elif not gaia_catalog:
             gaia_catalog = self.gaia_source_table
 
-        positions = []
-        
-        for i in gaia_catalog:
-
-            if 'mag' in gaia_catalog.colnames and i['mag'] < 16:
-                continue
-            if 'x' in gaia_catalog.colnames:
-                positions.append( ( i['x'] , i['y'] ) ) ##Pixel coords for each source
-            else:
-                positions.append((i['xcentroid'].value , i['ycentroid'].value))
+        ##Pixel coords for each source, as one (N,2) array
+        if 'x' in gaia_catalog.colnames:
+            xpos = np.asarray(gaia_catalog['x'], dtype=float)
+            ypos = np.asarray(gaia_catalog['y'], dtype=float)
+        else:
+            xpos = units.Quantity(gaia_catalog['xcentroid']).value
+            ypos = units.Quantity(gaia_catalog['ycentroid']).value
+        keep = np.ones(len(gaia_catalog), dtype=bool)
+        if 'mag' in gaia_catalog.colnames:
+            # rows with a masked mag are kept, as only bright stars are dropped
+            keep = ~np.ma.filled(gaia_catalog['mag'] < 16, False)
+        positions = np.column_stack([xpos[keep], ypos[keep]])
         
         ##Set up the apertures
 
@@ -662,21 +719,31 @@ class FitsImage:
         
         aperture_radius = 2 * FWHM / pixscale
         apertures = CircularAperture(positions, r= aperture_radius)
-
-        annulus_aperture = CircularAnnulus(positions, r_in = aperture_radius + 5 , r_out = aperture_radius + 10)
-        annulus_masks = annulus_aperture.to_mask(method='center')
-        
-        ##Background subtraction using sigma clipped stats.
-        ##Uses a median value from the annulus
-        bkg_median = []
-        for mask in annulus_masks:
-            annulus_data = mask.multiply(self.sci.data)
-            annulus_data_1d = annulus_data[mask.data > 0]
-            _ , median_sigclip, _ = sigma_clipped_stats(annulus_data_1d)
-            bkg_median.append(median_sigclip)
+        
+        if self._bkg2d is not None:
+            ##A Background2D sky map was already made by detect_sources,
+            ##so just look up the sky at each source position
+            ny, nx = self._bkg2d.background.shape
+            ix = np.clip(np.round(positions[:,0]).astype(int), 0, nx - 1)
+            iy = np.clip(np.round(positions[:,1]).astype(int), 0, ny - 1)
+            bkg_median = self._bkg2d.background[iy, ix]
+        else:
+            ##Background subtraction using sigma clipped stats.
+            ##Uses a median value from the annulus. The annulus pixels of every
+            ##source go into one NaN-padded array, so the sigma clipping is done
+            ##in a single vectorized call instead of once per source
+            annulus_aperture = CircularAnnulus(positions, r_in = aperture_radius + 5 , r_out = aperture_radius + 10)
+            annulus_masks = annulus_aperture.to_mask(method='center')
+            annulus_values = [mask.multiply(self.sci.data)[mask.data > 0]
+                              for mask in annulus_masks]
+            npixmax = max(len(values) for values in annulus_values)
+            annulus_stack = np.full((len(annulus_values), npixmax), np.nan)
+            for i, values in enumerate(annulus_values):
+                annulus_stack[i, :len(values)] = values
+            _ , bkg_median, _ = sigma_clipped_stats(annulus_stack, axis=1)
             
         ##Perform photometry and subtract out background
-        bkg_median = np.array(bkg_median)
+        bkg_median = np.asarray(bkg_median)
         phot = aperture_photometry(self.sci.data, apertures)
         phot['annulus_median'] = bkg_median
         phot['aper_bkg'] = bkg_median * apertures.area
@@ -749,11 +816,9 @@ class FitsImage:
         ycat = self.gaia_source_table['y']
 
         # Find the nearest Gaia catalog source for each measured star
-        icat = []
-        for i in range(len(xphot)):
-            dist = np.sqrt((xphot[i].value - xcat)**2 +
-                           (yphot[i].value - ycat)**2)
-            icat.append(dist.argmin())
+        cattree = cKDTree(np.column_stack([np.asarray(xcat), np.asarray(ycat)]))
+        _, icat = cattree.query(
+            np.column_stack([xphot.value, yphot.value]), k=1)
         star_mag = self.gaia_source_table['mag'][icat]
         star_mag_err = self.gaia_source_table['magerr']
 
@@ -815,7 +880,7 @@ class FitsImage:
         return
 
 
-    def extract_psf_stars(self, SNthresh=100, verbose=False):
+    def extract_psf_stars(self, SNthresh=100, verbose=False, local_sky=False):
         """
         Extract postage-stamp image cutouts of stars from the image, for use
         in building an ePSF model
@@ -827,49 +892,40 @@ class FitsImage:
         S/N > SNthresh are used for PSF construction.
 
         verbose: bool : verbose output
+
+        local_sky: bool : if True, also subtract the sigma-clipped median of
+        each star cutout (the remaining local sky) from that cutout
         """
         gaiacat = self.gaia_source_table
         image = self.sci
+        # any cached ePSF model was built from the previous psfstars
+        self._epsf_cache = {}
 
 
         # Define bounding boxes for the extractions so we can remove
         # any stars with overlaps. We want stars without overlaps
         # so the PSF construction doesn't require any deblending.
         # TODO : allow user to set the overlap size, or set based on FWHM
-        bboxes = []
-        for i in gaiacat:
-            x = i['x']
-            y = i['y']
-            size = 25
-            ixmin, ixmax = int(x - size/2), int(x + size/2)
-            iymin, iymax = int(y - size/2), int(y + size/2)
-
-            bbox = BoundingBox(ixmin=ixmin, ixmax=ixmax, iymin=iymin, iymax=iymax)
-            bboxes.append(bbox)
-        bboxes = Column(bboxes)
-        gaiacat.add_column(bboxes,name='bbox')
-
-        # using the bbox of each star from results to determine intersections,
-        # dont want confusion of multi-stars for ePSF
-        intersections = []
-        for i,obj1 in enumerate(bboxes):
-            for j in range(i+1,len(bboxes)):
-                obj2 = bboxes[j]
-                if obj1.intersection(obj2):
-                    #print(obj1,obj2)
-                    # these are the ones to remove
-                    intersections.append(obj1)
-                    intersections.append(obj2)
+        # The box edges are kept as integer columns rather than as a column
+        # of BoundingBox objects.
+        x = np.asarray(gaiacat['x'])
+        y = np.asarray(gaiacat['y'])
+        half = _PSFSTARCUTOUTSIZE_ // 2
+        ixmin = (x - half).astype(np.int32)
+        iymin = (y - half).astype(np.int32)
+        ixmax = ixmin + _PSFSTARCUTOUTSIZE_
+        iymax = iymin + _PSFSTARCUTOUTSIZE_
+        gaiacat['ixmin'] = ixmin
+        gaiacat['ixmax'] = ixmax
+        gaiacat['iymin'] = iymin
+        gaiacat['iymax'] = iymax
+
+        # using the bbox of each star to determine intersections,
+        # dont want confusion of multi-stars for ePSF.
+        # A KD-tree finds the overlapping pairs without testing all N^2.
+        intersections = find_overlapping_boxes(ixmin, ixmax, iymin, iymax)
         # use the intersections found to remove stars
-        j=0
-        rows=[]
-        for i in gaiacat:
-            if i['bbox'] in intersections:
-                #tmp.remove(i)
-                row=j
-                rows.append(row)
-            j+=1
-        gaiacat.remove_rows(rows)
+        gaiacat.remove_rows(intersections)
         if verbose:
             print('{} stars, after removing intersections'.format(len(gaiacat)))
 
@@ -892,49 +948,68 @@ class FitsImage:
         data = image.data
         hdr = image.header
         # the header has L1 bkg values; should be the same as sigma clipped stats
-        L1mean,L1med,L1sigma,L1fwhm = hdr['L1MEAN'],hdr['L1MEDIAN'],hdr['L1SIGMA'],hdr['L1FWHM'] # counts, fwhm in arcsec
-        mean_val, median_val, std_val = sigma_clipped_stats(data, sigma=2.)
+        L1mean,L1med,L1sigma,L1fwhm = [hdr.get(key) for key in
+            ['L1MEAN','L1MEDIAN','L1SIGMA','L1FWHM']] # counts, fwhm in arcsec
+        # so use the header sky, and only sigma clip the whole image without it
+        median_val = L1med
+        if median_val is None:
+            # string cenfunc/stdfunc keep astropy on its fast nan-based clipping
+            # (using bottleneck if installed) rather than numpy masked arrays
+            mean_val, median_val, std_val = sigma_clipped_stats(
+                data, sigma=2., maxiters=5, cenfunc='median', stdfunc='std')
         WMSSKYBR = hdr['WMSSKYBR'] # mag/arcsec^2 of sky bkg measured
         # AGGMAG the guide star magnitude header value would be simpler but it is given as unknown, ra/dec are provided for it though
         # grab some other useful header values now
         pixscale,saturate,maxlin = hdr['PIXSCALE'],hdr['SATURATE'],hdr['MAXLIN'] # arcsec/pixel, counts for saturation and non-linearity levels
 
         # need bkg subtracted to extract stars, want to build ePSF using just star brightness
-        data -= median_val # L1med
-        nddata = NDData(data=data)
+        # (a new float32 array, leaving the image data itself untouched; the
+        # star cutouts and so the EPSFBuilder iterations stay in float32)
+        data_bkgsub = np.subtract(data, median_val, dtype=np.float32) # L1med
+        nddata = NDData(data=data_bkgsub)
         psfstars_extracted = extract_stars(nddata, catalogs=gaiacat,
                                            size=_PSFSTARCUTOUTSIZE_)
-        # using the bbox of each star from results to determine intersections,
-        # we don't want confusion of blended stars in our ePSF
-        intersections = []
-        for i,obj1 in enumerate(psfstars_extracted.bbox):
-            for j in range(i+1,len(psfstars_extracted.bbox)):
-                obj2 = psfstars_extracted.bbox[j]
-                if obj1.intersection(obj2):
-                    #print(obj1,obj2)
-                    # these are the ones to remove
-                    intersections.append(obj1)
-                    intersections.append(obj2)
-        # use the intersections found to remove stars
-        tmp = [i for i in psfstars_extracted] # get a list of stars rather than single photutils obj with all of them
-        for i in tmp:
-            if i.bbox in intersections:
-                tmp.remove(i)
+        # the cutouts have the same size and centers as the catalog boxes, so
+        # the overlapping stars were already removed from gaiacat above
+        # (extract_stars itself only drops stars too close to the edge)
+        # get a list of stars rather than single photutils obj with all of them
+        tmp = list(psfstars_extracted)
         if verbose:
-            print('{} stars, after removing intersections'.format(len(tmp)))
+            print('{} stars extracted'.format(len(tmp)))
 
         # note ref.fits doesn't have saturate and maxlin available
         # the image should be just one of the trims
-        for i in tmp:
-            if np.max(i.data) > saturate:
-                tmp.remove(i)
-            elif np.max(i.data) > maxlin:
-                tmp.remove(i)
+        # (filter into a new list; removing from tmp while looping over it
+        # would skip the star after each one removed)
+        maxval = min(saturate, maxlin)
+        if len(tmp) and len(set(star.data.shape for star in tmp)) == 1:
+            # all cutouts have the same shape: one reduction over the stack
+            peaks = np.stack([star.data for star in tmp]).reshape(
+                len(tmp), -1).max(axis=1)
+        else:
+            peaks = np.fromiter((star.data.max() for star in tmp),
+                                dtype=float, count=len(tmp))
+        tmp = [star for star, peak in zip(tmp, peaks) if peak <= maxval]
 
         if verbose:
             print('removed stars above saturation or non-linearity level'
                   '~ {}, {} ADU; now have {}'.format(
                 saturate,maxlin,len(tmp)))
+
+        if local_sky and len(tmp):
+            if len(set(star.data.shape for star in tmp)) == 1:
+                # one call clips all the cutouts (in parallel with numba)
+                skylevels = cutout_sky_levels(
+                    np.stack([star.data for star in tmp]))
+            else:
+                # cutouts of different sizes are clipped one at a time
+                skylevels = [cutout_sky_levels(star.data[np.newaxis])[0]
+                             for star in tmp]
+            for star, sky in zip(tmp, skylevels):
+                star.data -= sky
+                # the star flux was estimated from the data before
+                star.flux = star.estimate_flux()
+
         psf_stars_selected = photutils.psf.EPSFStars(tmp)
 
         """
@@ -952,8 +1027,9 @@ class FitsImage:
 
         return
 
-    def build_epsf_model(self, oversampling=2,
-                         verbose=False, save_suffix=None, overwrite=False):
+    def build_epsf_model(self, oversampling=None,
+                         verbose=False, save_suffix=None, overwrite=False,
+                         n_jobs=1):
         """Build an effective PSF model from a set of stars in the image
         Uses a list of star locations (from Gaia)  which are below
         non-linearity/saturation
@@ -962,7 +1038,8 @@ class FitsImage:
         ----------
 
         oversampling: int : the oversampling scale for the PSF model. See the
-          photutils ePSF model documentation for details.
+          photutils ePSF model documentation for details. If None, use 1 when
+          the PSF is already well sampled (FWHM > 3 pixels), otherwise 2.
 
         verbose: bool : verbose output
 
@@ -971,24 +1048,39 @@ class FitsImage:
             If set to None, then no output file is generated
 
         overwrite: bool
-            If True, overwrite any existing ePSF model saved as a .pkl file
-            If False, and a .pkl exists with the name indicated by save_suffix,
+            If True, overwrite any existing ePSF model saved as a fits file
+            (<rootname>_<save_suffix>_epsf.fits).
+            If False, and that file (or a legacy <rootname>_<save_suffix>.pkl)
+            exists,
             just read that in without remaking the PSF model.
+            If False, a model already built by an earlier call for the same
+            (unchanged) file and oversampling is also reused.
+
+        n_jobs: int
+            Number of processes to use (-1 for all cores). With n_jobs != 1,
+            joblib installed and more than 64 PSF stars, ePSF models are built
+            from chunks of the stars in parallel and averaged (see
+            build_epsf_parallel). Otherwise one model is built from all stars.
 
         """
         # check for existence of pre-made PSF model and load it if desired
         rootfilename = os.path.splitext(
             os.path.splitext(self.filename)[0])[0]
         if save_suffix is not None and overwrite == False:
-            epsf_filename = rootfilename + '_' + save_suffix + '.pkl'
-            if os.path.isfile(epsf_filename):
-                self.load_epsfmodel_from_pickle(save_suffix=save_suffix)
+            if self.load_epsfmodel(save_suffix=save_suffix) == 0:
                 return
 
+        # reuse a model built earlier in this session, unless the file changed
+        # (the cache is also cleared when fakes are planted or psfstars change)
+        cachekey = (self.filename, os.path.getmtime(self.filename),
+                    oversampling)
+        if not overwrite and cachekey in self._epsf_cache:
+            self.epsf, self.fitted_stars = self._epsf_cache[cachekey]
+            return
 
         # check for existence of gaia source table and fetch/read it if needed
-        catfilename = rootfilename + '_' + save_suffix + '.' + _GAIACATEXT_
-        if os.path.isfile(catfilename):
+        catfilename, catformat = self._find_gaia_catalog(save_suffix)
+        if catfilename is not None:
             try:
                 self.read_gaia_sources(save_suffix=save_suffix)
             except:
@@ -1016,40 +1108,86 @@ class FitsImage:
         # without any oversampling
         # ePSF basic x,y,sigma 3 param model should be easily obtained if
         # consider that 3*pixscale < fwhm
-        epsf_builder = EPSFBuilder(oversampling=oversampling, maxiters=10,
-                                   progress_bar=True)
-        epsf, fitted_stars = epsf_builder(self.psfstars)
+        # so only oversample by default when that isn't the case; each
+        # EPSFBuilder iteration then works on ~4x fewer pixels per star
+        if oversampling is None:
+            oversampling = 1 if 3 * pixscale < L1fwhm else 2
+        if n_jobs != 1 and joblib is not None and len(self.psfstars) > 64:
+            epsf, fitted_stars = build_epsf_parallel(
+                self.psfstars, oversampling=oversampling, maxiters=10,
+                n_jobs=n_jobs)
+        else:
+            epsf_builder = EPSFBuilder(oversampling=oversampling, maxiters=10,
+                                       progress_bar=True)
+            epsf, fitted_stars = epsf_builder(self.psfstars)
 
         self.epsf = epsf
         self.fitted_stars = fitted_stars
+        self._epsf_cache[cachekey] = (epsf, fitted_stars)
 
         if self.zeropoint is None:
             self.measure_zeropoint()
 
-        # TODO : Can we save this ePSF model as a fits extension instead?
         if save_suffix:
-            # Write out the ePSF model
+            # Write out the ePSF model as a fits image, with the
+            # oversampling factors in the header
             # TODO: make a function for generating output file names
+            # (the _epsf tag keeps it apart from a Gaia catalog saved as
+            # <rootname>_<save_suffix>.fits)
             rootfilename = os.path.splitext(
                 os.path.splitext(self.filename)[0])[0]
-            epsf_filename = rootfilename + '_' + save_suffix + '.pkl'
-            pickle.dump( self.epsf, open( epsf_filename, "wb" ) )
+            epsf_filename = rootfilename + '_' + save_suffix + '_epsf.fits'
+            oversamp = np.atleast_1d(self.epsf.oversampling)
+            epsfhdr = fits.Header()
+            epsfhdr['OVRSAMP1'] = int(oversamp[0])
+            epsfhdr['OVRSAMP2'] = int(oversamp[-1])
+            fits.PrimaryHDU(data=np.asarray(self.epsf.data, dtype=np.float32),
+                            header=epsfhdr).writeto(epsf_filename,
+                                                    overwrite=True)
 
         return
 
-    def load_epsfmodel_from_pickle(self, save_suffix):
-        """Read in an ePSF model from a pickle file
+    def load_epsfmodel(self, save_suffix):
+        """Read in an ePSF model saved by build_epsf_model, as
+        <rootname_of_this_fits_file>_<save_suffix>_epsf.fits
+        or, if that does not exist, from a legacy pickle file
+        <rootname_of_this_fits_file>_<save_suffix>.pkl
 
         Parameters
         ----------
 
         save_suffix: str
             The suffix for the epsf model filename to be read.
+
+        Returns 0 on success, -1 if neither file exists.
         """
         rootfilename = os.path.splitext(
             os.path.splitext(self.filename)[0])[0]
+        epsf_filename = rootfilename + '_' + save_suffix + '_epsf.fits'
+        if os.path.isfile(epsf_filename):
+            epsfdata, epsfhdr = fits.getdata(epsf_filename, header=True)
+            oversampling = (epsfhdr['OVRSAMP1'], epsfhdr['OVRSAMP2'])
+            # the saved data is already normalized
+            self.epsf = EPSFModel(epsfdata, oversampling=oversampling,
+                                  normalize=False)
+            return 0
         epsf_filename = rootfilename + '_' + save_suffix + '.pkl'
-        self.epsf = pickle.load(open( epsf_filename, "rb" ) )
+        if os.path.isfile(epsf_filename):
+            self.epsf = pickle.load(open( epsf_filename, "rb" ) )
+            return 0
+        return -1
+
+    def load_epsfmodel_from_pickle(self, save_suffix):
+        """Read in an ePSF model saved by build_epsf_model.
+        Kept for backwards compatibility, see load_epsfmodel.
+
+        Parameters
+        ----------
+
+        save_suffix: str
+            The suffix for the epsf model filename to be read.
+        """
+        self.load_epsfmodel(save_suffix)
         return
 
 
@@ -1098,7 +1236,6 @@ class FitsImage:
         """
         
         
-        fakes = []
         file_header = self.hdulist[0].header
         
         # If we are not adding to an existing file
@@ -1115,24 +1252,18 @@ class FitsImage:
             savename = None
             
         
-        RA = []
-        DEC = []
-        SCA = []
-        F = []
-        MOD = []
-        X = []
-        Y = []
-        for i in file_header.keys():
-             if i[0:2] == "FK" and int(i[2:5]) not in fakes: #Identify header entries for fake SN
-                N = i[2:5]
-                fakes.append(int(N))
-                RA.append(file_header["FK" + str(N) + "RA"])
-                DEC.append(file_header["FK" + str(N) + "DEC"])
-                SCA.append(file_header["FK" + str(N) + "SCA"])
-                F.append(file_header["FK" + str(N) + "MOD"])
-                MOD.append(file_header["FK" + str(N) + "MOD"])
-                X.append(file_header["FK" + str(N) + "X"])
-                Y.append(file_header["FK" + str(N) + "Y"])
+        #Identify header entries for fake SN: one FKnnnX card per fake
+        fakekey = re.compile(r"^FK(\d{3})X$")
+        fakes = sorted({match.group(1) for match in
+                        map(fakekey.match, file_header.keys()) if match})
+
+        RA = [file_header.get("FK" + N + "RA") for N in fakes]
+        DEC = [file_header.get("FK" + N + "DEC") for N in fakes]
+        SCA = [file_header.get("FK" + N + "SCA") for N in fakes]
+        F = [file_header.get("FK" + N + "F") for N in fakes]
+        MOD = [file_header.get("FK" + N + "MOD") for N in fakes]
+        X = [file_header.get("FK" + N + "X") for N in fakes]
+        Y = [file_header.get("FK" + N + "Y") for N in fakes]
 
         racol = Column(RA , name = "ra")
         deccol = Column(DEC , name = "dec")
@@ -1177,7 +1308,7 @@ class FitsImage:
 
         save_suffix: str
             If provided, read the fake sourc catalog named as
-            <rootname_of_this_fits_file>_<save_suffix>.<_GAIACATEXT_>
+            <rootname_of_this_fits_file>_<save_suffix>.<_FSNCATEXT_>
             Will be ignored if a filename is provided
 
         filename: str
@@ -1189,11 +1320,11 @@ class FitsImage:
         
         """
         
-        if filename != None:
+        if filename is not None:
+            readname = filename
+        else:
             root = os.path.splitext(os.path.splitext(self.filename)[0])[0]
             readname = root + "_" + save_suffix + "." + _FSNCATEXT_
-        else:
-            readname = filename
         
         self.fakesncat = Table.read(readname , format =_FSNCATFORMAT_)
         
@@ -1404,13 +1535,16 @@ class FakePlanter:
         # in degrees
         # NOTE: I'm not sure if this is relative to the +x axis or
         # relative to North.
-        orientation = units.deg * np.array(
-            [srcprop.orientation.value for srcprop
+        orientation = np.array(
+            [srcprop.orientation.to_value(units.deg) for srcprop
              in hostgalaxies["Source Properties"][galaxy_indices] ])
 
-        # Compute the offsets from galaxy center position
-        delta_x = d_pix * np.cos((orientation + phi_deg * units.deg))
-        delta_y = d_pix * np.sin((orientation + phi_deg * units.deg))
+        # Compute the offsets from galaxy center position, with one
+        # cos/sin over the angles of all fakes (as plain arrays)
+        phi_rad = np.deg2rad(orientation + np.asarray(phi_deg, dtype=float))
+        d_pix_arr = np.asarray(d_pix, dtype=float)
+        delta_x = d_pix_arr * np.cos(phi_rad)
+        delta_y = d_pix_arr * np.sin(phi_rad)
 
         # Apply the offsets to get the x,y locations where the fakes
         # will go (separately for each image in the triplet)
@@ -1473,8 +1607,8 @@ class FakePlanter:
         # the lensed locations
         lensed_locations = self.templateim.lensed_locations
         galaxy_indices = lensed_locations.meta['galaxy_indices']
-        delta_x = lensed_locations.meta['delta_x'].value
-        delta_y = lensed_locations.meta['delta_y'].value
+        delta_x = np.asarray(lensed_locations.meta['delta_x'])
+        delta_y = np.asarray(lensed_locations.meta['delta_y'])
         phi_deg = lensed_locations.meta['phi_deg']
         d_pix = lensed_locations.meta['d_pix']
         
@@ -1816,21 +1950,28 @@ class FakePlanter:
         diff_wcs = self.diffim.wcs
 
         nfakes = len(fake_indices)
+
+        # template pixel locations of all the fakes, in one pair of wcs calls
+        xdiffs = np.array([self.diffim.sci.header[ f'FK{idx:03d}X' ]
+                           for idx in fake_indices], dtype=float)
+        ydiffs = np.array([self.diffim.sci.header[ f'FK{idx:03d}Y' ]
+                           for idx in fake_indices], dtype=float)
+        sky_locations = wcsutils.pixel_to_skycoord(xdiffs, ydiffs, diff_wcs)
+        x_templates, y_templates = wcsutils.skycoord_to_pixel(
+            sky_locations, template_wcs)
         
         MEFS = []
         for i, idx in zip(range(nfakes), fake_indices):
             
             # get the fake x,y locations
-            xdiff = self.diffim.sci.header[ f'FK{idx:03d}X' ]
-            ydiff = self.diffim.sci.header[ f'FK{idx:03d}Y' ]
+            xdiff = xdiffs[i]
+            ydiff = ydiffs[i]
             diff_location = (xdiff,ydiff)
             xsearch = self.searchim.sci.header[ f'FK{idx:03d}X' ]
             ysearch = self.searchim.sci.header[ f'FK{idx:03d}Y' ]
             search_location = (xsearch,ysearch)
-            sky_location = wcsutils.pixel_to_skycoord(
-                xdiff, ydiff, diff_wcs)
-            template_location = wcsutils.skycoord_to_pixel(sky_location,template_wcs)
-            x_template,y_template = template_location
+            x_template,y_template = x_templates[i], y_templates[i]
+            template_location = (x_template,y_template)
             # and flux
             flux = self.diffim.sci.header[ f'FK{idx:03d}F' ]
             
@@ -1908,6 +2049,16 @@ class FakePlanter:
         search_wcs = self.searchim.wcs
         diff_wcs = self.diffim.wcs
         
+        # search/template pixel locations of all the candidates, converted
+        # with one call per wcs rather than per candidate
+        xdiffs = np.asarray(false_positives['x'], dtype=float)
+        ydiffs = np.asarray(false_positives['y'], dtype=float)
+        sky_locations = wcsutils.pixel_to_skycoord(xdiffs, ydiffs, diff_wcs)
+        xsearches, ysearches = wcsutils.skycoord_to_pixel(
+            sky_locations, search_wcs)
+        x_templates, y_templates = wcsutils.skycoord_to_pixel(
+            sky_locations, template_wcs)
+
         MEFS = []
         for i in range(len(false_positives)):
             
@@ -1915,12 +2066,10 @@ class FakePlanter:
             xdiff = false_positives[i]['x']
             ydiff = false_positives[i]['y']
             diff_location = (xdiff,ydiff)
-            sky_location = wcsutils.pixel_to_skycoord(
-                xdiff, ydiff, diff_wcs)
-            search_location = wcsutils.skycoord_to_pixel(sky_location,search_wcs)
-            xsearch,ysearch = search_location
-            template_location = wcsutils.skycoord_to_pixel(sky_location,template_wcs)
-            x_template,y_template = template_location
+            xsearch,ysearch = xsearches[i], ysearches[i]
+            search_location = (xsearch,ysearch)
+            x_template,y_template = x_templates[i], y_templates[i]
+            template_location = (x_template,y_template)
             # and mag
             mag = false_positives[i]['mag']
             
@@ -1972,18 +2121,17 @@ class FakePlanter:
         pixscale = image_with_fakes.sci.header["PIXSCALE"]
         FWHM = image_with_fakes.sci.header["L1FWHM"]
         radius = FWHM / pixscale
+        radius2 = radius ** 2 # compare squared distances, no sqrt needed
 
         detect = []
-        x = []
-        y = []
+        x = fakeposition[:,0]
+        y = fakeposition[:,1]
         magnitudes = []
 
         for i in fakeposition:
-            x.append(i[0])
-            y.append(i[1])
             d = 0
             for k in image_with_fakes.sourcecatalog:
-                if np.sqrt( (k.centroid[1].value - i[0]) ** 2 + (k.centroid[0].value - i[1]) ** 2) < radius:
+                if (k.centroid[1].value - i[0]) ** 2 + (k.centroid[0].value - i[1]) ** 2 < radius2:
                     d = 1
                     break
             detect.append(d)
@@ -2004,7 +2152,7 @@ class FakePlanter:
             found = False
             for k in image_with_fakes.stellar_phot_table:
 
-                if np.sqrt( (k['xcenter'].value - xposition) ** 2 + (k['ycenter'].value - yposition) ** 2) < radius:
+                if (k['xcenter'].value - xposition) ** 2 + (k['ycenter'].value - yposition) ** 2 < radius2:
                     if np.isnan(k['mag']):
                         magnitudes.append(k['mag'])
                     else:
@@ -2047,6 +2195,7 @@ class FakePlanter:
         pixscale = clean_diff.sci.header["PIXSCALE"]
         FWHM = clean_diff.sci.header["L1FWHM"]
         radius = FWHM / pixscale
+        radius2 = radius ** 2 # compare squared distances, no sqrt needed
 
         ##Find zeropoint (and other quantities) if necessary
         if not self.searchim.gaia_source_table:
@@ -2080,7 +2229,7 @@ class FakePlanter:
             y.append(ycenter)
             found = False
             for k in clean_diff.stellar_phot_table:
-                if np.sqrt( (xcenter - k['xcenter'].value) ** 2 + (ycenter - k['xcenter'].value ) ** 2 ) < radius:
+                if (xcenter - k['xcenter'].value) ** 2 + (ycenter - k['xcenter'].value ) ** 2 < radius2:
                     mag.append(k['mag'] + self.searchim.zeropoint)
                     found = True
                     break
@@ -2173,11 +2322,12 @@ class FakePlanter:
         return [TP,FN,FP,TN]
     
     def get_fake_locations(self,image_with_fakes=None):
-        """Returns a list of fakeIDs and (x,y) pixel locations for the
+        """Returns arrays of fakeIDs and (x,y) pixel locations for the
         specified image.  The info for each fake is read from the
         'sci' attribute of the specified FitsImage object.  The 'sci' attribute
         is a fits HDU object, and the info for each fake is extracted from
-        the header keywords (starting with 'FK').
+        the header keywords (starting with 'FK').  The result is cached on
+        the FitsImage until fakes are planted in it again.
 
         Parameters
         ----------
@@ -2185,9 +2335,15 @@ class FakePlanter:
             A FitsImage object containing the planted fake sources in it.
             (default self.diffim)
 
+        Returns
+        -------
+        fakeIDs : int64 `~numpy.ndarray` of shape (M,)
+        fake_positions : float64 `~numpy.ndarray` of shape (M,2)
         """
         if image_with_fakes is None:
             image_with_fakes = self.diffim
+        if image_with_fakes._fake_xy is not None:
+            return image_with_fakes._fake_ids, image_with_fakes._fake_xy
         hdr = image_with_fakes.sci.header
         fake_plant_x_keys = [key for key in hdr.keys() if \
                              key.startswith('FK') and key.endswith('X')]
@@ -2199,16 +2355,26 @@ class FakePlanter:
             fakeIDs.append(int(fake_id_str))
             fake_plant_x.append(hdr['FK%sX'%fake_id_str])
             fake_plant_y.append(hdr['FK%sY'%fake_id_str])
-        fake_positions = np.array([fake_plant_x,fake_plant_y]).T
-        return fakeIDs, fake_positions
-
+        image_with_fakes._fake_ids = np.asarray(fakeIDs, dtype=np.int64)
+        image_with_fakes._fake_xy = np.ascontiguousarray(
+            np.array([fake_plant_x,fake_plant_y], dtype=np.float64).T.reshape(-1,2))
+        return image_with_fakes._fake_ids, image_with_fakes._fake_xy
 
-    def set_fake_detection_header(self,image_with_fakes,detection_table=None,outfilename=None):
-        if detection_table is None:
-            detection_table = self.detection_table
 
-        for row in detection_table:
-            image_with_fakes.header['FK%sDET'%row['fakeID']] = row['detected']
+    def set_fake_detection_header(self,image_with_fakes,detection_table=None,outfilename=None,
+                                  fake_ids=None,detected=None):
+        """Record the detected flag of each fake in the header, as FKnnnDET.
+        The IDs and flags are taken from fake_ids and detected when given,
+        otherwise from the detection_table (default self.detection_table).
+        """
+        if fake_ids is None or detected is None:
+            if detection_table is None:
+                detection_table = self.detection_table
+            fake_ids = detection_table['fakeID']
+            detected = detection_table['detected']
+
+        image_with_fakes.header.update(zip(['FK%sDET'%fkID for fkID in fake_ids],
+                                           np.asarray(detected).tolist()))
         if isinstance(outfilename,str):
             fits.writeto(outfilename,image_with_fakes,image_with_fakes.header,overwrite=True)
         return image_with_fakes
@@ -2229,7 +2395,8 @@ class FakePlanter:
         image_with_fakes : `~fakeplanting.FitsImage`
             A fits image class containing the planted fake sources (default self.diffim)
         fake_plant_locations : list or `~numpy.ndarray`
-            2D array containing the x,y locations of the fake sources (default read self.diffim.sci.header)
+            2D array containing the x,y locations of the fake sources (default read self.diffim.sci.header).
+            If given, the fakes are numbered by their order in it.
         source_catalog : :class:`~photutils.segmentation.properties.SourceCatalog`
             Detected source catalog 
 
@@ -2252,44 +2419,43 @@ class FakePlanter:
 
         if fake_plant_locations is None:
             fake_plant_ids,fake_plant_locations = self.get_fake_locations(image_with_fakes)
+        else:
+            fake_plant_locations = np.asarray(fake_plant_locations, dtype=np.float64).reshape(-1,2)
+            fake_plant_ids = np.arange(len(fake_plant_locations))
 
         # use locations and a search radius on detections and plant locations to get true positives
         tbl = source_catalog.to_table()
-        tbl_x,tbl_y = [i.value for i in tbl['xcentroid']], [i.value for i in tbl['ycentroid']]
-        tbl_pixels = list(zip(tbl_x,tbl_y))        
+        tbl_x = np.asarray(tbl['xcentroid'].value, dtype=np.float64)
+        tbl_y = np.asarray(tbl['ycentroid'].value, dtype=np.float64)
+        tbl_pixels = np.column_stack([tbl_x,tbl_y])
         search = gridSize # fwhm*n might be better criteria
 
-        truths = []
-        binary_detection_dict = {key:0 for key in fake_plant_ids}
-        for pixel in tbl_pixels:
-            for ind in range(len(fake_plant_locations)):
-                i = fake_plant_locations[ind]
-                if pixel[0] > i[0] - search  and pixel[0] < i[0] + search and pixel[1] > i[1] - search and pixel[1] < i[1] + search:
-                    truths.append([tuple(i),pixel])
-                    binary_detection_dict[fake_plant_ids[ind]] = 1
-                    break # TODO Think about multiple detections
-                else:
-                    continue
+        # first fake within the search radius of each detection (-1 if none)
+        first_fake = match_fakes(tbl_pixels, fake_plant_locations, search) # TODO Think about multiple detections
+
+        matched = np.flatnonzero(first_fake >= 0)
+        binary_detection = np.zeros(len(fake_plant_locations), dtype=np.uint8)
+        binary_detection[first_fake[matched]] = 1
 
-        plant_pixels = []
-        det_src_pixels = []
-        for i in truths:
-            plant_pix = i[0]
-            det_src_pix = i[1]
-            if plant_pix not in plant_pixels:
-                plant_pixels.append(plant_pix)
-                det_src_pixels.append(det_src_pix)
+        # keep only the first detection of each fake
+        uniq_fake_idx, first_det = np.unique(first_fake[matched], return_index=True)
+        plant_pixels = fake_plant_locations[uniq_fake_idx]
+        det_src_pixels = tbl_pixels[matched[first_det]]
         
-        N_plants_detected = len(plant_pixels)
+        N_plants_detected = int(binary_detection.sum())
         efficiency = N_plants_detected/len(fake_plant_locations)
-        binary_detection = [binary_detection_dict[fkID] for fkID in fake_plant_ids]
-        detection_table = Table([fake_plant_ids,fake_plant_locations[:,0],fake_plant_locations[:,1],binary_detection],
-                    names=['fakeID','pixX','pixY','detected'])
-        
-        if isinstance(image_with_fakes,FitsImage):
-            image_with_fakes = self.set_fake_detection_header(image_with_fakes = image_with_fakes.sci,detection_table = detection_table)
-        else:
-            image_with_fakes = self.set_fake_detection_header(image_with_fakes = image_with_fakes,detection_table = detection_table)
+        rec = np.empty(len(fake_plant_locations), dtype=[('fakeID','i8'),('pixX','f8'),
+                                                         ('pixY','f8'),('detected','u1')])
+        rec['fakeID'] = fake_plant_ids
+        rec['pixX'] = fake_plant_locations[:,0]
+        rec['pixY'] = fake_plant_locations[:,1]
+        rec['detected'] = binary_detection
+        detection_table = Table(rec)
+        
+        # the header cards go on the sci HDU of a FitsImage, or on the HDU itself
+        sci = getattr(image_with_fakes,'sci',image_with_fakes)
+        image_with_fakes = self.set_fake_detection_header(image_with_fakes = sci,
+                                fake_ids = fake_plant_ids,detected = binary_detection)
         self.detection_efficiency = efficiency
         self.detection_table = detection_table
         self.diffim = image_with_fakes
@@ -11,7 +11,6 @@ from photutils.datasets import make_gaussian_sources_image
 
 import numpy as np
 import itertools
-import copy
 
 def plant_unit_test(self,accuracy=0.05):
     # unit test
@@ -28,8 +27,13 @@ def has_fakes(self):
     """Check if fake stars have been planted in the image"""
     return self.has_fakes
 
-def plant_fakes(self,epsf_model,locations,writetodisk=False,saveas="planted.fits"):
+def plant_fakes(self,epsf_model,locations,writetodisk=False,saveas="planted.fits",
+                reuse_buffer=False):
     """Function for planting fake stars in the diff image.
+
+    If reuse_buffer is True, the returned hdu holds its pixels in a buffer
+    that is reused (overwritten) by the next plant_fakes call with
+    reuse_buffer=True, which saves allocating a full image copy each time.
     """
     # using the ePSF model embedded in the fits file, plant a grid
     # of fakes or plant fakes around galaxies with varying magnitudes
@@ -48,26 +52,43 @@ def plant_fakes(self,epsf_model,locations,writetodisk=False,saveas="planted.fits
     epsf = epsf_model.epsf # the array of data 
 
     # copying so can leave original data untouched
-    cphdu = hdu.copy()
+    if reuse_buffer:
+        # the copy goes into one buffer kept for later calls; the psf is
+        # added in place, so make sure the pixels are floats
+        dtype = hdu.data.dtype
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.float32
+        buffer = getattr(self, '_plant_buffer', None)
+        if buffer is None or buffer.shape != hdu.data.shape or buffer.dtype != dtype:
+            buffer = np.empty(hdu.data.shape, dtype=dtype)
+            self._plant_buffer = buffer
+        np.copyto(buffer, hdu.data, casting='unsafe')
+        cphdu = hdu.__class__(data=buffer, header=hdu.header.copy())
+    else:
+        cphdu = hdu.copy()
     cpim = cphdu.data
     cphdr = cphdu.header
+    # the psf is added in place, so make sure the pixels are floats
+    if not np.issubdtype(cpim.dtype, np.floating):
+        cpim = cpim.astype(np.float32)
+        cphdu.data = cpim
     
     wcs,frame = WCS(cphdr),cphdr['RADESYS'].lower()
     
     # location should be list of pixels [(x1,y1),(x2,y2)...(xn,yn)]
-    for pix in locations:
-        pix = list(pix)
-        revpix = copy.copy(pix)
-        revpix.reverse()
-        row,col=revpix
-        nrows,ncols=epsf.shape
-        # +2 in these to grab a couple more than needed, the correct shapes for broadcasting taken using actual psf.shapes
-        rows=np.arange(int(np.round(row-nrows/2)),int(np.round(row+nrows/2))+2) 
-        cols=np.arange(int(np.round(col-ncols/2)),int(np.round(col+ncols/2))+2) 
-        rows = rows[:epsf.shape[0]]
-        cols = cols[:epsf.shape[1]]
-        cpim[rows[:, None], cols] += epsf
-        np.float64(cpim)
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    nrows,ncols=epsf.shape
+    # first row/col of the epsf stamp for every location
+    rowstart = np.round(locations[:, 1] - nrows/2).astype(int)
+    colstart = np.round(locations[:, 0] - ncols/2).astype(int)
+    # add each stamp through a plain slice, clipped at the image edges
+    # (fancy indexing would wrap negative indices to the other side)
+    for r0, c0 in zip(rowstart, colstart):
+        rr0, rr1 = max(r0, 0), min(r0 + nrows, cpim.shape[0])
+        cc0, cc1 = max(c0, 0), min(c0 + ncols, cpim.shape[1])
+        if rr0 >= rr1 or cc0 >= cc1:
+            continue
+        cpim[rr0:rr1, cc0:cc1] += epsf[rr0-r0:rr1-r0, cc0-c0:cc1-c0]
     
     # inserting some new header values
     cphdr['fakeSN']=True 
@@ -102,11 +123,9 @@ def lattice(self):
     x = list(range(0+edge,NX-edge+1,spacing)) # +1 to make inclusive
     y = list(range(0+edge,NY-edge+1,spacing))
     pixels = list(itertools.product(x, y))
-    skycoords = [] # skycoord locations corresponding to the pixels  
-    for i in range(len(pixels)):
-        pix = pixels[i]
-        skycoord=astropy.wcs.utils.pixel_to_skycoord(pix[0],pix[1],wcs)
-        skycoords.append(skycoord)
+    # skycoord locations corresponding to the pixels, in one wcs call
+    xpix, ypix = np.array(pixels, dtype=float).T
+    skycoords = list(astropy.wcs.utils.pixel_to_skycoord(xpix, ypix, wcs))
 
     self.has_lattice = True # if makes it through lattice update has_lattice
 
@@ -1,5 +1,5 @@
 ##Test File
-import sys,os,traceback,pickle,unittest,warnings
+import sys,os,traceback,pickle,unittest,warnings,types
 import numpy as np
 from astropy.table import Table
 
@@ -164,6 +164,50 @@ class TestFitsImage(unittest.TestCase):
         self.assertTrue(self.FitsImageClassInstance.epsf is not None)
         self.assertTrue(self.FitsImageClassInstance.epsf.data.sum()>0)
 
+    @unittest.skipIf(_GOFAST_,"Skipping slow `test_epsf_model_fits_roundtrip`")
+    def test_epsf_model_fits_roundtrip(self):
+        """Check that an ePSF model saved as a fits file reads back the same.
+        """
+        save_suffix = 'TestEPSFRoundTrip'
+        rootfilename = os.path.splitext(os.path.splitext(
+            self.FitsImageClassInstance.filename)[0])[0]
+        # a Gaia catalog saved with the same suffix must not be clobbered
+        gaiacatfilename = rootfilename + '_' + save_suffix + '.fits'
+        gaiacat = self.FitsImageClassInstance.gaia_source_table
+        gaiacat.write(gaiacatfilename, format='fits', overwrite=True)
+
+        self.FitsImageClassInstance.build_epsf_model(
+            oversampling=2, save_suffix=save_suffix, overwrite=True)
+        epsf_built = self.FitsImageClassInstance.epsf
+
+        self.FitsImageClassInstance.epsf = None
+        status = self.FitsImageClassInstance.load_epsfmodel(save_suffix)
+        gaiacat_read = Table.read(gaiacatfilename, format='fits')
+        os.remove(rootfilename + '_' + save_suffix + '_epsf.fits')
+        os.remove(gaiacatfilename)
+
+        self.assertEqual(len(gaiacat_read), len(gaiacat))
+        self.assertEqual(gaiacat_read.colnames, gaiacat.colnames)
+        self.assertEqual(status, 0)
+        epsf_read = self.FitsImageClassInstance.epsf
+        self.assertTrue(np.allclose(epsf_read.data, epsf_built.data, rtol=1e-6))
+        self.assertTrue(np.all(np.atleast_1d(epsf_read.oversampling) ==
+                               np.atleast_1d(epsf_built.oversampling)))
+
+    def test_add_psf_records_input_flux(self):
+        """Check that add_psf records the flux of the input psf model, also
+        when the model itself is used (and changed) for the planting."""
+        from photutils.psf import IntegratedGaussianPRF
+        psf = IntegratedGaussianPRF(sigma=2., flux=1000.)
+        posflux = Table(names=['x_fit', 'y_fit', 'flux_fit'],
+                        data=[[100., 200.], [100., 200.], [50., 70.]])
+        # add_psf is written for objects with sci and wcs attributes
+        planter = types.SimpleNamespace(sci=self.FitsImageClassInstance.sci,
+                                        wcs=self.FitsImageClassInstance.wcs)
+        cphdu = diffimageml.util.add_psf(planter, psf, posflux,
+                                         subshape=(11, 11), copy_psf=False)
+        self.assertEqual(float(cphdu.header['F_epsf']), 1000.)
+
     def test_measure_zeropoint(self):
         """Check measuring of zeropoint from known stars in the image"""
         self.FitsImageClassInstance.do_stellar_photometry(
@@ -244,6 +288,100 @@ class TestSourceDetection(unittest.TestCase):
         self.FitsImageClassInstance.hdulist.close()
 
 
+class TestMatching(unittest.TestCase):
+    """Check that the different code paths of the position matching
+    helpers in util agree with a brute force loop."""
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        # integer positions, so many pairs sit exactly on the search radius
+        self.dets = rng.integers(0, 60, size=(400, 2)).astype(float)
+        self.fakes = rng.integers(10, 40, size=(150, 2)).astype(float)
+
+    def _match_paths(self):
+        """(name, use_numba, maxbroadcast) of each match path"""
+        paths = [('broadcast', False, 10**9), ('kdtree', False, 0)]
+        if diffimageml.util.numba is not None:
+            paths.append(('numba', True, 10**9))
+        return paths
+
+    def test_match_fakes(self):
+        search = 2.
+        expected = np.array([next((i for i, fk in enumerate(self.fakes)
+                                   if ((det - fk)**2).sum() < search**2), -1)
+                             for det in self.dets])
+        for name, use_numba, maxbroadcast in self._match_paths():
+            with self.subTest(path=name):
+                first_fake = diffimageml.util.match_fakes(
+                    self.dets, self.fakes, search, maxbroadcast=maxbroadcast,
+                    use_numba=use_numba)
+                self.assertTrue(np.array_equal(first_fake, expected))
+
+    def test_match_fakes_radius_is_strict(self):
+        # the first fake is exactly at the search radius, the second inside
+        dets = [[10., 10.], [20., 20.]]
+        fakes = [[12., 10.], [21.9, 20.]]
+        for name, use_numba, maxbroadcast in self._match_paths():
+            with self.subTest(path=name):
+                first_fake = diffimageml.util.match_fakes(
+                    dets, fakes, 2., maxbroadcast=maxbroadcast,
+                    use_numba=use_numba)
+                self.assertEqual(list(first_fake), [-1, 1])
+
+    def test_find_overlapping_boxes(self):
+        ixmin, iymin = self.dets.astype(int).T
+        ixmax, iymax = ixmin + 5, iymin + 5
+        n = len(ixmin)
+        expected = [i for i in range(n) if any(
+            ixmin[i] < ixmax[j] and ixmax[i] > ixmin[j] and
+            iymin[i] < iymax[j] and iymax[i] > iymin[j]
+            for j in range(n) if j != i)]
+        for maxbroadcast in (10**9, 0):
+            with self.subTest(maxbroadcast=maxbroadcast):
+                overlapping = diffimageml.util.find_overlapping_boxes(
+                    ixmin, ixmax, iymin, iymax, maxbroadcast=maxbroadcast)
+                self.assertEqual(list(overlapping), expected)
+
+    def test_find_overlapping_boxes_touching(self):
+        # boxes that only share an edge do not overlap (ixmax is exclusive)
+        for maxbroadcast in (10**9, 0):
+            overlapping = diffimageml.util.find_overlapping_boxes(
+                [0, 5, 20], [5, 10, 25], [0, 0, 0], [5, 5, 5],
+                maxbroadcast=maxbroadcast)
+            self.assertEqual(len(overlapping), 0)
+
+
+class TestSkyLevels(unittest.TestCase):
+    """Check the sigma-clipped sky levels of a stack of cutouts."""
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.cutouts = rng.normal(100., 2., size=(64, 25, 25))
+        # some NaN pixels and some bright (star-like) outliers in each cutout
+        self.cutouts[:, :2, :] = np.nan
+        self.cutouts[:, 10:13, 10:13] += rng.uniform(50., 500., size=(64, 3, 3))
+
+    def test_cutout_sky_levels(self):
+        from astropy.stats import sigma_clipped_stats
+        _, expected, _ = sigma_clipped_stats(
+            self.cutouts.reshape(len(self.cutouts), -1),
+            sigma=3., maxiters=5, axis=1)
+        sky = diffimageml.util.cutout_sky_levels(self.cutouts, sigma=3.,
+                                                 maxiters=5)
+        self.assertTrue(np.allclose(sky, expected))
+
+    @unittest.skipIf(diffimageml.util.numba is None, "numba is not installed")
+    def test_cutout_sky_levels_numba(self):
+        # the parallel compiled clipper gives the same as the python version
+        stack = self.cutouts.reshape(len(self.cutouts), -1)
+        expected = [diffimageml.util._sigclip_median_row.py_func(row, 3., 5)
+                    for row in stack]
+        for _ in range(3):
+            sky = diffimageml.util.cutout_sky_levels(self.cutouts, sigma=3.,
+                                                     maxiters=5)
+            self.assertTrue(np.array_equal(sky, expected))
+
+
 class TestMachineLearning(unittest.TestCase):
 
     def setUp(self) -> None: